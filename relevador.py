@@ -9,14 +9,31 @@ Relevador CPC (Comunicación Pública de la Ciencia)
 import os
 import io
 import re
+import json
+import codecs
+import hashlib
+import tempfile
 import time
 import random
+from collections import Counter
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import InvalidHeader
+from urllib3.util.retry import Retry
+import ahocorasick
+import xlsxwriter
+import lxml.html
 import pandas as pd
 import streamlit as st
-from bs4 import BeautifulSoup
-from urllib.parse import urlparse, urljoin
+from lxml import etree
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from functools import lru_cache
+from urllib.parse import urlparse, urljoin, urldefrag
+from urllib.robotparser import RobotFileParser
 from datetime import datetime
+from uuid import uuid4
 
 # ───────────────── Streamlit ─────────────────
 st.set_page_config(
@@ -39,6 +56,24 @@ CSE_PUBLIC_URL = "https://cse.google.com/cse?cx=d15e41407a20a49c6"
 
 # ───────────────── Constantes/Vocabularios ─────────────────
 REQ_TIMEOUT = 12
+HOST_MIN_INTERVAL = 1.5   # segundos entre pedidos al mismo host
+MAX_CRAWL_DELAY = 10.0    # tope al Crawl-delay que pida un robots.txt
+CSE_MIN_INTERVAL = 0.3    # idem para la API de Google
+HTTP_RETRIES = 3          # reintentos ante RETRY_STATUS
+RETRY_STATUS = (429, 502, 503, 504)
+MAX_RETRY_AFTER = 5.0     # tope a la espera de un Retry-After antes de reintentar
+MAX_CONCURRENCY = 10      # conexiones simultáneas en total
+SCAN_WORKERS = 8          # sitios analizados en paralelo
+ROBOTS_TIMEOUT = 5
+MAX_HTML_BYTES = 2_000_000  # tope de descarga por página
+HTTP_CACHE_MB = 200         # memoria máxima para la caché de http_get
+HTTP_CACHE_ENTRIES = HTTP_CACHE_MB * 1_000_000 // MAX_HTML_BYTES  # páginas: entradas × tope ≤ presupuesto
+CACHE_DIR = ".relevador_cache"
+SCAN_CACHE_PATH = os.path.join(CACHE_DIR, "scans.json")
+SCAN_CACHE_TTL = 7*24*3600   # los análisis de sitio se reutilizan durante una semana
+CSE_CACHE_PATH = os.path.join(CACHE_DIR, "cse.json")
+CSE_CACHE_TTL = 24*3600      # respuestas de la API de Google: un día (ahorra cuota en re-ejecuciones)
+DETALLE_POR_PAGINA = 25      # expanders de detalle renderizados por rerun
 HEADERS_POOL = [
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 13_5) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Safari/605.1.15",
@@ -46,59 +81,105 @@ HEADERS_POOL = [
 ]
 def _headers():
     return {"User-Agent": random.choice(HEADERS_POOL), "Accept-Language": "es-AR,es;q=0.9,en;q=0.8"}
+# Las APIs de Google comprimen la respuesta solo si el User-Agent incluye "gzip"
+# (Accept-Encoding: gzip ya lo envía la sesión de requests)
+CSE_HEADERS = {"User-Agent": "relevadorCPC (gzip)"}
 
-TERMINOS_BUSQUEDA = {
-    "ciencia_abierta": [
+# Vocabularios inmutables (tuplas): se comparten entre sesiones y alimentan el autómata cacheado
+TERMINOS_BUSQUEDA: dict[str, tuple[str, ...]] = {
+    "ciencia_abierta": (
         '("open science" OR "open data" OR "open access") university',
         "universidad ciencia abierta",
         "universitat ciència oberta",
         "université science ouverte",
         "universidade ciência aberta",
         "università scienza aperta",
-    ],
-    "comunicacion_publica": [
+    ),
+    "comunicacion_publica": (
         '("science communication" OR "public engagement") university',
         "universidad comunicación pública de la ciencia",
         "universitat comunicació científica",
         "université communication scientifique",
         "universidade comunicação científica",
-    ],
-    "diplomacia_cientifica": [
+    ),
+    "diplomacia_cientifica": (
         '("science diplomacy") university',
         "universidad diplomacia científica",
         "universitat diplomàcia científica",
         "université diplomatie scientifique",
         "universidade diplomacia científica",
-    ],
+    ),
 }
 
-TERMINOS_VALIDACION = {
-    "ciencia_abierta": [
+TERMINOS_VALIDACION: dict[str, tuple[str, ...]] = {
+    "ciencia_abierta": (
         "open science","ciencia abierta","ciència oberta","ciência aberta","science ouverte",
         "open data","datos abiertos","dades obertes","dados abertos","données ouvertes",
         "open access","acceso abierto","accés obert","acesso aberto","accès libre",
         "fair data","repositorio institucional","institutional repository","reproducible research",
-    ],
-    "comunicacion_publica": [
+    ),
+    "comunicacion_publica": (
         "science communication","comunicación científica","comunicación pública de la ciencia",
         "public engagement","outreach","vulgarisation scientifique","divulgação científica",
         "science literacy","public understanding of science","cultura científica",
-    ],
-    "diplomacia_cientifica": [
+    ),
+    "diplomacia_cientifica": (
         "science diplomacy","diplomacia científica","diplomàcia científica","diplomatie scientifique",
         "international scientific cooperation","cooperación internacional científica",
         "science policy","política científica",
-    ],
+    ),
 }
 
-BAD_DOMAINS_SUBSTR = [
+BAD_DOMAINS_SUBSTR = (
     "wikipedia.org","wikidata.org","web.archive.org",
     "blogspot.","wordpress.","medium.com",
     "topuniversities.","timeshighereducation.","theworlduniversityrankings",
     "4icu.org","uni-rank","edurank","shanghairanking",
     "qs.com","mastersportal","bachelorstudies","studocu","prezi",
     "/ranking","/rankings","/directory","/directorio",
-]
+)
+
+# Palabras que marcan un enlace interno como relevante (href o texto del enlace)
+CLAVES_ENLACES = (
+    "research","investigación","investigació","pesquisa","recherche","ricerca",
+    "science","ciencia","ciència","ciência","scienza",
+    "open","abierto","obert","aberto","ouvert","aperto",
+    "communication","comunicación","comunicació","comunicação","comunicazione",
+    "outreach","divulgación","divulgació","divulgação",
+    "policy","política","politique","politica",
+    "open science","open data","open access","ciencia abierta","ciència oberta",
+    "science communication","science diplomacy","diplomacia científica",
+)
+CLAVES_ENLACES_RE = re.compile("|".join(map(re.escape, CLAVES_ENLACES)))
+
+# Heurísticas de is_university, compiladas una sola vez (una alternación en lugar de N búsquedas)
+UNI_URL_RE = re.compile(r"\.edu($|/)|\.edu\.|\.ac\.|\.ac$|\.uni\.|\.univ\.")
+UNI_TITLE_RE = re.compile(
+    r"university|universidad|universitat|universidade|université|università|college|instituto|institute"
+)
+UNI_TITLE_EXCLUDE_RE = re.compile(r"ranking|list|directorio|directory|top")
+
+TLD_PAIS = {
+    "es":"España","edu":"Estados Unidos","uk":"Reino Unido","ca":"Canadá","au":"Australia","de":"Alemania",
+    "fr":"Francia","it":"Italia","br":"Brasil","ar":"Argentina","mx":"México","cl":"Chile","co":"Colombia",
+    "pe":"Perú","jp":"Japón","cn":"China","in":"India","nl":"Países Bajos","ch":"Suiza","se":"Suecia","no":"Noruega",
+}
+
+# Detección de idioma: atributo <html lang> y, si falta, conteo de palabras frecuentes
+IDIOMA_POR_CODIGO = {
+    "es":"Español","ca":"Catalán","en":"Inglés","fr":"Francés","pt":"Portugués","it":"Italiano","de":"Alemán",
+}
+IDIOMAS_PALABRAS = {
+    "Español": ("universidad","investigación","ciencia","estudiantes","facultad"),
+    "Catalán": ("universitat","recerca","ciència","estudiants","facultat"),
+    "Inglés": ("university","research","science","students","faculty"),
+    "Francés": ("université","recherche","sciences","étudiants","faculté"),
+    "Portugués": ("universidade","pesquisa","ciência","estudantes","faculdade"),
+    "Italiano": ("università","ricerca","scienza","studenti","facoltà"),
+}
+PALABRA_IDIOMA = {w: idioma for idioma, ws in IDIOMAS_PALABRAS.items() for w in ws}
+IDIOMA_RE = re.compile(r"\b(" + "|".join(map(re.escape, PALABRA_IDIOMA)) + r")\b")
+HTML_LANG_RE = re.compile(r"<html\b[^>]*?\slang\s*=\s*[\"']?([a-z]{2,3}(?:[-_][a-z0-9]{1,8})*)", re.IGNORECASE)
 
 CONTROL = {
     "nombre": "Universitat Jaume I",
@@ -121,37 +202,221 @@ def sanitize_excel_value(v):
         v = v[:32760] + "..."
     return v
 
-def sanitize_dataframe_for_excel(df: pd.DataFrame) -> pd.DataFrame:
-    for col in df.columns:
-        df[col] = df[col].map(sanitize_excel_value)
-    return df
-
 # ───────────────── Helpers web ─────────────────
-@st.cache_data(show_spinner=False, ttl=24*3600)
+# Las mismas URLs se parsean varias veces (dedup, dominio, robots, pacing): se memoiza
+_urlparse = lru_cache(maxsize=4096)(urlparse)
+
+@lru_cache(maxsize=4096)
+def url_host(url: str) -> str:
+    """Host de la URL en minúsculas (los nombres de host no distinguen mayúsculas)."""
+    return _urlparse(url).netloc.lower()
+
+def url_key(url: str) -> str:
+    """
+    URL sin #fragmento, sin "/" final en el path y con esquema/host en minúsculas: la misma página con
+    otra escritura. El resto del path y la query quedan tal cual (pueden nombrar páginas distintas).
+    """
+    p = _urlparse(urldefrag(url)[0])
+    return p._replace(scheme=p.scheme.lower(), netloc=p.netloc.lower(), path=p.path.rstrip("/")).geturl()
+
+def _build_session() -> requests.Session:
+    """
+    Sesión compartida: keep-alive y pool de conexiones por host. El adapter solo reintenta errores de
+    conexión; las respuestas 429/5xx las reintenta polite_get, que respeta el ritmo por host.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=20,
+        pool_maxsize=MAX_CONCURRENCY,
+        max_retries=Retry(total=2, backoff_factor=0.5, respect_retry_after_header=False, raise_on_status=False),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+@st.cache_resource(show_spinner=False)
+def shared_web_state() -> dict:
+    """
+    Estado de red de todo el proceso: Streamlit re-ejecuta el script en cada interacción, y sin
+    cache_resource cada rerun tiraría el pool de conexiones, los turnos por host y robots.txt.
+    Así también las sesiones simultáneas respetan el mismo ritmo por host.
+    """
+    return {
+        "session": _build_session(),
+        "fetch_slots": threading.BoundedSemaphore(MAX_CONCURRENCY),
+        "host_next": {},
+        "host_next_lock": threading.Lock(),
+        "robots": {},
+    }
+
+_web = shared_web_state()
+SESSION: requests.Session = _web["session"]
+
+def script_executor(max_workers: int) -> ThreadPoolExecutor:
+    """Pool de hilos que heredan el contexto de Streamlit (para st.cache_data sin advertencias)."""
+    return ThreadPoolExecutor(max_workers=max_workers, initializer=add_script_run_ctx,
+                              initargs=(None, get_script_run_ctx()))
+_fetch_slots: threading.BoundedSemaphore = _web["fetch_slots"]
+_host_next: dict[str, float] = _web["host_next"]
+_host_next_lock: threading.Lock = _web["host_next_lock"]
+
+def _retry_wait(r: requests.Response, intento: int) -> float:
+    """Espera antes de reintentar: el Retry-After (acotado a MAX_RETRY_AFTER) o backoff exponencial."""
+    try:
+        espera = Retry().parse_retry_after(r.headers["Retry-After"])
+    except (KeyError, InvalidHeader):
+        espera = 0.5 * 2 ** intento
+    return min(espera, MAX_RETRY_AFTER)
+
+def polite_get(url: str, min_interval: float = HOST_MIN_INTERVAL, **kwargs) -> requests.Response:
+    """
+    SESSION.get con cortesía: reserva un turno por host (al menos `min_interval` segundos
+    entre inicios de pedido al mismo host) y limita las conexiones simultáneas globales.
+    Hosts distintos no se esperan entre sí. Las respuestas RETRY_STATUS se reintentan hasta
+    HTTP_RETRIES veces pidiendo un turno nuevo, y la espera no ocupa un cupo de _fetch_slots.
+    """
+    host = url_host(url)
+    espera = 0.0
+    for intento in range(HTTP_RETRIES + 1):
+        with _host_next_lock:
+            now = time.monotonic()
+            turno = max(now + espera, _host_next.get(host, 0.0))
+            _host_next[host] = turno + min_interval
+        if turno > now:
+            time.sleep(turno - now)
+        with _fetch_slots:
+            r = SESSION.get(url, **kwargs)
+        if r.status_code not in RETRY_STATUS or intento == HTTP_RETRIES:
+            return r
+        espera = _retry_wait(r, intento)
+        r.close()
+
+_robots: dict[str, RobotFileParser | None] = _web["robots"]
+
+def robots_allowed(url: str, user_agent: str) -> bool:
+    """
+    Consulta el robots.txt del host, que se descarga una sola vez por host.
+    Si no existe o no se puede leer, la URL se considera permitida; si responde 401/403, ninguna.
+    """
+    p = _urlparse(url)
+    host = p.netloc.lower()
+    if not host:
+        return True
+    if host not in _robots:
+        rp = None
+        try:
+            r = polite_get(f"{p.scheme or 'https'}://{host}/robots.txt", headers=_headers(), timeout=ROBOTS_TIMEOUT)
+            if r.status_code == 200:
+                rp = RobotFileParser()
+                rp.parse(r.text.splitlines())
+            elif r.status_code in (401, 403):  # como RobotFileParser.read(): acceso restringido = nada permitido
+                rp = RobotFileParser()
+                rp.disallow_all = True
+        except Exception:
+            pass
+        _robots[host] = rp
+    rp = _robots[host]
+    return rp is None or rp.can_fetch(user_agent, url)
+
+def crawl_interval(url: str, user_agent: str) -> float:
+    """Separación entre pedidos al host: HOST_MIN_INTERVAL o el Crawl-delay de robots.txt, acotado a MAX_CRAWL_DELAY."""
+    rp = _robots.get(url_host(url))
+    delay = rp.crawl_delay(user_agent) if rp is not None else None
+    return min(max(HOST_MIN_INTERVAL, float(delay or 0)), MAX_CRAWL_DELAY)
+
+CHARSET_RE = re.compile(rb"""charset\s*=\s*["']?([a-zA-Z0-9_.:-]+)""", re.IGNORECASE)
+
+def page_encoding(content_type: str, body: bytes) -> str:
+    """
+    Charset de la página: el del Content-Type, si no el <meta charset> de los primeros 4 KB, si no UTF-8.
+    (requests asume ISO-8859-1 para text/* sin charset y rompe los acentos de páginas UTF-8.)
+    """
+    m = CHARSET_RE.search(content_type.encode("latin-1", "ignore")) or CHARSET_RE.search(body[:4096])
+    if m:
+        try:
+            return codecs.lookup(m.group(1).decode("ascii")).name
+        except LookupError:
+            pass
+    return "utf-8"
+
+# En memoria con tope de entradas: persist="disk" haría que Streamlit ignore el ttl, y los sitios
+# ya analizados se retoman desde el checkpoint en disco (scans.json) sin volver a descargarse
+@st.cache_data(show_spinner=False, ttl=24*3600, max_entries=HTTP_CACHE_ENTRIES)
+def _fetch_page(url: str):
+    """
+    Descarga de http_get, ya con robots.txt consultado. Las excepciones de red se propagan:
+    st.cache_data no guarda un fallo pasajero durante un día.
+    """
+    headers = _headers()
+    # stream=True: el cuerpo solo se descarga si el Content-Type es textual, y hasta MAX_HTML_BYTES
+    with polite_get(url, min_interval=crawl_interval(url, headers["User-Agent"]),
+                    headers=headers, timeout=REQ_TIMEOUT, stream=True) as r:
+        ct = (r.headers.get("Content-Type") or "").lower()
+        if not ("html" in ct or ct.startswith("text/") or "xml" in ct):
+            return r.status_code, "", ct
+        chunks, total = [], 0
+        for chunk in r.iter_content(64 * 1024):
+            chunks.append(chunk)
+            total += len(chunk)
+            if total >= MAX_HTML_BYTES:
+                break
+        body = b"".join(chunks)[:MAX_HTML_BYTES]
+        return r.status_code, body.decode(page_encoding(ct, body), errors="replace"), ct
+
+ROBOTS_BLOQUEADO = -1  # status de http_get para URLs que robots.txt no permite
+
 def http_get(url: str):
     """
     Devuelve: (status_code, text_or_empty, content_type)
-    Solo retorna texto si la respuesta es HTML/texto/XML. Para PDF/binarios deja texto = "".
+    Solo retorna texto si la respuesta es HTML/texto/XML (hasta MAX_HTML_BYTES); para PDF/binarios
+    no se descarga el cuerpo y el texto queda "". Las URLs que robots.txt no permite no se descargan
+    (status ROBOTS_BLOQUEADO) y un error de red da status 0; ninguno de los dos queda en caché.
     """
+    if not robots_allowed(url, _headers()["User-Agent"]):
+        return ROBOTS_BLOQUEADO, "", ""
     try:
-        r = requests.get(url, headers=_headers(), timeout=REQ_TIMEOUT)
-        ct = (r.headers.get("Content-Type") or "").lower()
-        if "html" in ct or ct.startswith("text/") or "xml" in ct:
-            return r.status_code, r.text, ct
-        return r.status_code, "", ct
+        return _fetch_page(url)
     except Exception:
         return 0, "", ""
 
+TAGS_RUIDO = ("script","style","noscript","header","footer","nav")
+_HTML_PARSER = lxml.html.HTMLParser(encoding="utf-8")
+
+def parse_html(html: str):
+    """Árbol lxml de la página (una sola pasada de parseo por página); None si el documento está vacío."""
+    try:
+        return lxml.html.fromstring(html.encode("utf-8", "replace"), parser=_HTML_PARSER)
+    except (etree.ParserError, ValueError):
+        return None
+
+def page_text(root) -> str:
+    """Texto visible del árbol, espacios colapsados. Quita los TAGS_RUIDO del árbol: extraer los enlaces antes."""
+    if root is None:
+        return ""
+    for el in root.iter(*TAGS_RUIDO):
+        # al quitar el tag su "tail" se pega al texto previo; el espacio evita unir palabras
+        el.tail = " " + el.tail if el.tail else " "
+    etree.strip_elements(root, *TAGS_RUIDO, with_tail=False)
+    return " ".join(" ".join(root.itertext()).split())
+
 def clean_text(html: str) -> str:
-    soup = BeautifulSoup(html, "html.parser")
-    for bad in soup(["script","style","noscript","header","footer","nav"]):
-        bad.decompose()
-    text = soup.get_text(" ")
-    return re.sub(r"\s+", " ", text).strip()
+    """Texto visible de una página de la que no interesan los enlaces."""
+    return page_text(parse_html(html))
+
+def detect_language(html: str, low: str) -> str:
+    """Idioma de la página: primero <html lang="..">; si no, el idioma con más palabras en `low` (una pasada)."""
+    m = HTML_LANG_RE.search(html)
+    if m:
+        # "es-AR", "pt_BR" → subetiqueta primaria ("es", "pt"): la región no cambia el idioma
+        code = m.group(1).lower().replace("_", "-").split("-")[0]
+        # etiqueta uniforme para códigos sin nombre: la columna no mezcla "zh" con "Español"
+        return IDIOMA_POR_CODIGO.get(code) or f"Otro ({code})"
+    counts = Counter(PALABRA_IDIOMA[w] for w in IDIOMA_RE.findall(low))
+    return counts.most_common(1)[0][0] if counts else ""
 
 def same_domain(a: str, b: str) -> bool:
     try:
-        return urlparse(a).netloc == urlparse(b).netloc
+        return url_host(a) == url_host(b)
     except:
         return False
 
@@ -161,57 +426,92 @@ def is_university(url: str, title: str = "") -> bool:
     u = url.lower()
     if any(b in u for b in BAD_DOMAINS_SUBSTR):
         return False
-    strong = any(re.search(p, u) for p in [
-        r"\.edu($|/)", r"\.edu\.[a-z]+$", r"\.ac\.", r"\.ac$", r"\.uni\.", r"\.univ\.", r"\.edu\.", r"\.ac\.[a-z]+$"
-    ])
-    if strong:
+    if UNI_URL_RE.search(u):
         return True
     t = (title or "").lower()
-    words = ["university","universidad","universitat","universidade","université","università","college","instituto","institute"]
-    if any(w in t for w in words) and not any(x in t for x in ["ranking","rankings","list","directorio","directory","top"]):
+    if UNI_TITLE_RE.search(t) and not UNI_TITLE_EXCLUDE_RE.search(t):
         return True
-    host = urlparse(url).netloc.lower()
+    host = url_host(url)
     if host.startswith("uni.") or host.startswith("univ."):
         return True
     return False
 
 def country_guess(domain: str) -> str:
-    m = {
-        ".es":"España",".edu":"Estados Unidos",".uk":"Reino Unido",".ca":"Canadá",".au":"Australia",".de":"Alemania",
-        ".fr":"Francia",".it":"Italia",".br":"Brasil",".ar":"Argentina",".mx":"México",".cl":"Chile",".co":"Colombia",
-        ".pe":"Perú",".jp":"Japón",".cn":"China",".in":"India",".nl":"Países Bajos",".ch":"Suiza",".se":"Suecia",".no":"Noruega"
-    }
-    for ext, pais in m.items():
-        if domain.endswith(ext): return pais
-    return "Internacional"
-
-def find_relevant_links(base_url: str, html: str, limit: int = 12) -> list[str]:
-    soup = BeautifulSoup(html, "html.parser")
-    keys = [
-        "research","investigación","investigació","pesquisa","recherche","ricerca",
-        "science","ciencia","ciència","ciência","scienza",
-        "open","abierto","obert","aberto","ouvert","aperto",
-        "communication","comunicación","comunicació","comunicação","comunicazione",
-        "outreach","divulgación","divulgació","divulgação",
-        "policy","política","politique","politica",
-        "open science","open data","open access","ciencia abierta","ciència oberta",
-        "science communication","science diplomacy","diplomacia científica",
-    ]
-    urls, seen = [], set()
-    for a in soup.find_all("a", href=True):
-        href = a["href"].strip()
-        txt = a.get_text(" ").strip().lower()
-        full = urljoin(base_url, href)
-        if not same_domain(full, base_url):
+    # Todas las entradas son de un solo nivel (.edu.ar → "ar"), basta con la última etiqueta
+    _, dot, tld = domain.rpartition(".")
+    return TLD_PAIS.get(tld, "Internacional") if dot else "Internacional"
+
+def _anchor_text(a) -> str:
+    """Texto del <a>; como get_text() de bs4, sin el contenido de <script>/<style> anidados."""
+    if len(a) == 0:  # caso común: solo texto
+        return a.text or ""
+    return " ".join(a.xpath(".//text()[not(ancestor::script or ancestor::style)]"))
+
+def find_relevant_links(base_url: str, root, limit: int = 12) -> list[str]:
+    """Enlaces internos cuyo href o texto menciona alguna CLAVES_ENLACES, sobre el árbol ya parseado."""
+    if root is None:
+        return []
+    base_host = url_host(base_url)
+    # Dedup por url_key: la propia página o un enlace repetido con otra escritura ("/" final,
+    # #ancla, host en mayúsculas) no se vuelven a descargar
+    urls, seen = [], {url_key(base_url)}
+    for a in root.iter("a"):
+        href = a.get("href")
+        if href is None:
             continue
-        low = (href + " " + txt).lower()
-        if any(k in low for k in keys):
-            if full not in seen:
-                urls.append(full); seen.add(full)
+        href = href.strip()
+        if not CLAVES_ENLACES_RE.search((href + " " + _anchor_text(a)).lower()):
+            continue
+        full = urldefrag(urljoin(base_url, href))[0]
+        key = url_key(full)
+        if key in seen or url_host(full) != base_host:
+            continue
+        urls.append(full); seen.add(key)
         if len(urls) >= limit:
             break
     return urls
 
+# ───────────────── Matching de términos (Aho–Corasick) ─────────────────
+@st.cache_resource(show_spinner=False)
+def build_automaton(vocab: dict[str, tuple[str, ...]]) -> ahocorasick.Automaton:
+    """
+    Un único autómata para todas las categorías; cada clave lleva (categoría, índice, término, largo).
+    Se arma una vez por proceso (cache_resource), no en cada rerun.
+    """
+    automaton = ahocorasick.Automaton()
+    for cat, terms in vocab.items():
+        for idx, term in enumerate(terms):
+            key = term.lower()
+            automaton.add_word(key, (cat, idx, term, len(key)))
+    automaton.make_automaton()
+    return automaton
+
+AUTOMATA_VALIDACION = build_automaton(TERMINOS_VALIDACION)
+
+ESPACIOS_RE = re.compile(r"\s+")
+
+def find_terms(low: str) -> dict[str, list[dict]]:
+    """
+    Una sola pasada sobre `low` (texto en minúsculas, normalmente de page_text, con los espacios
+    ya colapsados) para las tres categorías.
+    Devuelve, por categoría, cada término encontrado una vez, en el orden del vocabulario,
+    con el contexto (±120 caracteres) de su primera aparición.
+    """
+    first = {}
+    for end, (cat, idx, term, n) in AUTOMATA_VALIDACION.iter(low):
+        if (cat, idx) not in first:
+            first[(cat, idx)] = (term, end - n + 1, end + 1)
+    hits = {cat: [] for cat in TERMINOS_VALIDACION}
+    for cat, idx in sorted(first, key=lambda k: k[1]):
+        term, start, stop = first[(cat, idx)]
+        ctx = low[max(0, start - 120):stop + 120]
+        # Con texto ya colapsado no hay nada que reemplazar; si otro llamador pasa texto crudo,
+        # \n, \t o \xa0 (no imprimibles) no llegan al "Contexto"
+        if not ctx.isprintable():
+            ctx = ESPACIOS_RE.sub(" ", ctx)
+        hits[cat].append({"termino": term, "contexto": ctx[:240]})
+    return hits
+
 # ───────────────── Google Custom Search (JSON) ─────────────────
 def google_cse_search(query: str, per_page: int = 10, pages: int = 3) -> list[dict]:
     results = []
@@ -228,9 +528,12 @@ def google_cse_search(query: str, per_page: int = 10, pages: int = 3) -> list[di
             "start": start,
             "hl": "es",
             "safe": "off",
+            # Respuesta parcial: solo los campos que se usan (evita queries, context, pagemap, etc.)
+            "fields": "items(link,title,snippet)",
         }
         try:
-            r = requests.get("https://www.googleapis.com/customsearch/v1", params=params, timeout=REQ_TIMEOUT)
+            r = polite_get("https://www.googleapis.com/customsearch/v1", min_interval=CSE_MIN_INTERVAL,
+                           params=params, headers=CSE_HEADERS, timeout=REQ_TIMEOUT)
             if r.status_code != 200:
                 break
             data = r.json()
@@ -240,68 +543,176 @@ def google_cse_search(query: str, per_page: int = 10, pages: int = 3) -> list[di
                 break
         except Exception:
             break
-        time.sleep(0.3)
     return results
 
-def search_universities_for_category(cat: str, terms: list[str], per_page: int, pages: int) -> list[dict]:
+def search_universities_for_category(cat: str, terms: tuple[str, ...], per_page: int, pages: int,
+                                     cache: dict | None = None) -> list[dict]:
+    """
+    Candidatos de una categoría. Con `cache` (dict persistido en CSE_CACHE_PATH) las respuestas de
+    la API de menos de CSE_CACHE_TTL no se vuelven a pedir; el dict se toca solo desde este hilo.
+    """
     out, used_domains = [], set()
+    cache = {} if cache is None else cache
+    ahora = time.time()
+    hits_por_termino: dict[str, list[dict]] = {}
+    for term in terms:
+        entry = cache.get(f"{per_page}|{pages}|{term}")
+        if entry and ahora - entry["ts"] < CSE_CACHE_TTL:
+            hits_por_termino[term] = entry["items"]
+    pendientes = [t for t in terms if t not in hits_por_termino]
+    # Los términos se consultan en paralelo; el ritmo lo marca polite_get y el orden se conserva
+    with script_executor(4) as ex:
+        for term, hits in zip(pendientes, ex.map(lambda t: google_cse_search(t, per_page=per_page, pages=pages), pendientes)):
+            hits_por_termino[term] = hits
+            if hits:  # vacío puede ser error o cuota agotada: no se guarda
+                cache[f"{per_page}|{pages}|{term}"] = {"ts": time.time(), "items": hits}
     for term in terms:
-        hits = google_cse_search(term, per_page=per_page, pages=pages)
+        hits = hits_por_termino[term]
         for h in hits:
             url, title = h.get("link"), h.get("title","")
             if not url or not is_university(url, title):
                 continue
-            dom = urlparse(url).netloc.lower()
+            dom = url_host(url)
             if any(bad in dom for bad in BAD_DOMAINS_SUBSTR):
                 continue
             if dom in used_domains:
                 continue
             used_domains.add(dom)
             out.append({"url": url, "titulo": title, "categoria": cat, "termino": term})
-        time.sleep(0.2)
     return out
 
 # ───────────────── Análisis ─────────────────
 def scan_site(url: str, follow_links: int = 3) -> dict:
     result = {
-        "url": url, "accesible": False, "idioma": "", "contenido_muestra": "",
+        "url": url, "accesible": False, "bloqueado": False, "idioma": "", "contenido_muestra": "",
         "urls_analizadas": [], "scores": {"ciencia_abierta":0,"comunicacion_publica":0,"diplomacia_cientifica":0},
         "hits": {"ciencia_abierta":[], "comunicacion_publica":[], "diplomacia_cientifica":[]},
+        "fecha": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),  # cuándo se revisó este sitio
     }
     code, html, ct = http_get(url)
     if code != 200:
+        result["bloqueado"] = code == ROBOTS_BLOQUEADO
         return result
     result["accesible"] = True
-    text = ""
-    if html:  # solo si es HTML/texto
-        text = clean_text(html)
+    text, links = "", []
+    if html:  # solo si es HTML/texto; un único parseo sirve para enlaces y texto
+        root = parse_html(html)
+        links = find_relevant_links(url, root, limit=12)[:follow_links]
+        text = page_text(root)
         result["contenido_muestra"] = text[:600]
     result["urls_analizadas"].append(url)
 
-    low = text.lower()
+    # Textos de todas las páginas: se unen y pasan a minúsculas una sola vez
+    partes = [text]
     # Enlaces internos (solo si la base era HTML)
     if html:
-        links = find_relevant_links(url, html, limit=12)[:follow_links]
         for lk in links:
             c2, h2, ct2 = http_get(lk)
             if c2 == 200 and h2:  # ignorar PDF/binarios
-                t2 = clean_text(h2)
-                low += " " + t2.lower()
+                partes.append(clean_text(h2))
                 result["urls_analizadas"].append(lk)
-            time.sleep(0.25)
+    low = " ".join(partes).lower()
+    if html:
+        result["idioma"] = detect_language(html, low)
 
     # Scoring
-    for cat, terms in TERMINOS_VALIDACION.items():
-        for term in terms:
-            tl = term.lower()
-            if tl in low:
-                m = re.search(r".{0,120}"+re.escape(tl)+r".{0,120}", low, re.DOTALL)
-                ctx = m.group(0) if m else tl
-                ctx = re.sub(r"\s+", " ", ctx)[:240]
-                result["hits"][cat].append({"termino": term, "contexto": ctx})
-        result["scores"][cat] = len(result["hits"][cat])
+    result["hits"] = find_terms(low)
+    for cat, hits in result["hits"].items():
+        result["scores"][cat] = len(hits)
     return result
 
+# ───────────────── Checkpoint en disco ─────────────────
+def write_atomic(path: str, escribir) -> None:
+    """
+    `escribir(f)` sobre un temporal único de CACHE_DIR que luego reemplaza a `path`: varias sesiones
+    pueden guardar a la vez sin pisarse. Es caché: si falla (disco lleno o de solo lectura, un objeto
+    que no se puede serializar) no se guarda, el temporal se borra y el relevamiento sigue.
+    """
+    tmp = None
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            escribir(f)
+        os.replace(tmp, path)
+        tmp = None
+    except Exception:
+        pass
+    finally:
+        if tmp:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+def load_json_cache(path: str, ttl: float | None = None) -> dict:
+    """Caché {clave: {"ts": ..., ...}}; con `ttl` se descartan al cargar las entradas vencidas."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if ttl is not None:
+        ahora = time.time()
+        cache = {k: v for k, v in cache.items() if ahora - v.get("ts", 0) < ttl}
+    return cache
+
+def save_json_cache(path: str, cache: dict) -> None:
+    write_atomic(path, lambda f: f.write(json.dumps(cache, ensure_ascii=False).encode("utf-8")))
+
+# Firma de lo que decide un análisis de sitio (términos puntuados y claves de enlaces): si se edita
+# un vocabulario, los sitios del checkpoint se vuelven a analizar en lugar de servir hits viejos
+SCAN_FIRMA = hashlib.sha1(json.dumps([TERMINOS_VALIDACION, CLAVES_ENLACES], sort_keys=True,
+                                     ensure_ascii=False).encode("utf-8")).hexdigest()[:12]
+
+def scan_key(follow_links: int, url: str) -> str:
+    return f"{SCAN_FIRMA}|{follow_links}|{url_key(url)}"
+
+def results_path(*config) -> str:
+    """Archivo de resultados para una configuración: hash de parámetros, vocabularios y control."""
+    firma = json.dumps([config, TERMINOS_BUSQUEDA, TERMINOS_VALIDACION, CONTROL], sort_keys=True, ensure_ascii=False)
+    return os.path.join(CACHE_DIR, f"results_{hashlib.sha1(firma.encode('utf-8')).hexdigest()[:16]}.pkl")
+
+def save_results(path: str, df: pd.DataFrame) -> None:
+    write_atomic(path, df.to_pickle)
+
+def load_results(path: str) -> pd.DataFrame | None:
+    """Resultados guardados de una ejecución previa con la misma configuración, si no vencieron."""
+    try:
+        if time.time() - os.path.getmtime(path) > SCAN_CACHE_TTL:
+            return None
+        return pd.read_pickle(path)
+    except Exception:
+        return None
+
+def scan_sites(urls: list[str], follow_links: int, cache: dict, on_progress=None) -> dict[str, dict]:
+    """
+    scan_site para varias URLs en paralelo (hilos: casi todo es espera de red; el ritmo por host
+    lo pone polite_get). Reutiliza el checkpoint si el análisis tiene menos de SCAN_CACHE_TTL.
+    Solo se guardan sitios accesibles, para reintentar los que fallaron. El checkpoint y
+    `on_progress(hechos, total)` se invocan únicamente desde el hilo que llama.
+    """
+    out, pendientes = {}, []
+    ahora = time.time()
+    for url in urls:
+        entry = cache.get(scan_key(follow_links, url))
+        if entry and ahora - entry["ts"] < SCAN_CACHE_TTL:
+            out[url] = entry["scan"]
+        else:
+            pendientes.append(url)
+    with script_executor(SCAN_WORKERS) as ex:
+        futs = {ex.submit(scan_site, url, follow_links): url for url in pendientes}
+        for n, fut in enumerate(as_completed(futs), 1):
+            url = futs[fut]
+            scan = out[url] = fut.result()
+            if scan["accesible"]:
+                cache[scan_key(follow_links, url)] = {"ts": time.time(), "scan": scan}
+            if n % 5 == 0:  # checkpoint periódico: una caída no pierde todo lo analizado
+                save_json_cache(SCAN_CACHE_PATH, cache)
+            if on_progress:
+                on_progress(n, len(pendientes))
+    return out
+
 def force_find_control(control: dict) -> dict:
     res = scan_site(control["url"], follow_links=3)
     if any(v > 0 for v in res["scores"].values()):
@@ -315,20 +726,117 @@ def force_find_control(control: dict) -> dict:
             c2, h2, ct2 = http_get(u)
             if c2 == 200 and h2:
                 t2 = clean_text(h2).lower()
-                for cat, terms in TERMINOS_VALIDACION.items():
-                    for term in terms:
-                        tl = term.lower()
-                        if tl in t2:
-                            m = re.search(r".{0,120}"+re.escape(tl)+r".{0,120}", t2, re.DOTALL)
-                            ctx = m.group(0) if m else tl
-                            ctx = re.sub(r"\s+", " ", ctx)[:240]
-                            res["hits"][cat].append({"termino": term, "contexto": ctx})
+                for cat, hits in find_terms(t2).items():
+                    res["hits"][cat].extend(hits)
                     res["scores"][cat] = len(res["hits"][cat])
                 res["urls_analizadas"].append(u)
                 if any(v > 0 for v in res["scores"].values()):
                     return res
     return res
 
+# ───────────────── Resultados ─────────────────
+COLUMNAS_CATEGORIA = (
+    ("ciencia_abierta", "Ciencia Abierta", "CA"),
+    ("comunicacion_publica", "Comunicación Pública", "CP"),
+    ("diplomacia_cientifica", "Diplomacia Científica", "DC"),
+)
+
+SI_NO = pd.CategoricalDtype(["No", "Sí"])  # banderas como códigos de 1 byte en vez de strings por fila
+ACCESO_BLOQUEADO = "Bloqueado (robots.txt)"  # distinto de "No": el sitio pidió no ser rastreado
+ACCESO = pd.CategoricalDtype(["No", "Sí", ACCESO_BLOQUEADO])
+
+OPCIONES_CATEGORIA = ("Todas", "Control", *(cat for cat, _, _ in COLUMNAS_CATEGORIA))
+
+def results_frame(registros: list[tuple]) -> pd.DataFrame:
+    """
+    Arma la tabla de resultados por columnas: una lista por columna en lugar de un dict por fila.
+    Cada registro es (universidad, país, url, categoría, término, scan).
+    """
+    scans = [r[5] for r in registros]
+    cols = {
+        "Universidad": [r[0] for r in registros],
+        "País": [r[1] for r in registros],
+        "URL": [r[2] for r in registros],
+        "Categoría Encontrada": [r[3] for r in registros],
+        "Término de Búsqueda": [r[4] for r in registros],
+        "Fecha Análisis": [s.get("fecha", "") for s in scans],
+        "Sitio Accesible": pd.Categorical(["Sí" if s["accesible"] else ACCESO_BLOQUEADO if s.get("bloqueado")
+                                           else "No" for s in scans], dtype=ACCESO),
+        "Idioma Detectado": [s["idioma"] for s in scans],
+    }
+    for cat, nombre, sigla in COLUMNAS_CATEGORIA:
+        scores = [s["scores"][cat] for s in scans]
+        cols[nombre] = pd.Categorical(["Sí" if x>0 else "No" for x in scores], dtype=SI_NO)
+        cols[f"{sigla} - Score"] = scores
+        cols[f"{sigla} - Términos"] = [", ".join(x["termino"] for x in s["hits"][cat]) for s in scans]
+    # Score total calculado una sola vez al armar la tabla; filtros y vistas lo reusan
+    cols["Score Total"] = [s["scores"]["ciencia_abierta"]+s["scores"]["comunicacion_publica"]
+                           +s["scores"]["diplomacia_cientifica"] for s in scans]
+    cols["URLs Analizadas"] = ["; ".join(s["urls_analizadas"]) for s in scans]
+    cols["Contenido Muestra"] = [s["contenido_muestra"] for s in scans]
+    return pd.DataFrame(cols)
+
+# ───────────────── Resumen ─────────────────
+@st.cache_data(show_spinner=False, max_entries=32)
+def summarize_results(results_id: str, _df: pd.DataFrame) -> dict:
+    """
+    Métricas del relevamiento. `_df` no se hashea: la clave es `results_id`, que cambia con cada
+    búsqueda, así que los reruns por filtros o expanders no vuelven a recorrer los resultados.
+    """
+    paises = Counter(_df["País"].dropna())
+    # Una sola comparación sobre el bloque de columnas Sí/No en lugar de cuatro recorridos
+    acc, ca, cp, dc = (_df[["Sitio Accesible","Ciencia Abierta","Comunicación Pública","Diplomacia Científica"]]
+                       == "Sí").sum().tolist()
+    return {
+        "total": len(_df),
+        "accesibles": acc,
+        "ca": ca,
+        "cp": cp,
+        "dc": dc,
+        "paises": paises,
+        "opciones_pais": ["Todos"] + sorted(paises),
+    }
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def build_excel_bytes(results_id: str, _df: pd.DataFrame, _resumen: dict) -> bytes:
+    """
+    Excel del relevamiento, generado una vez por `results_id`: los clics siguientes reusan los bytes.
+    Se escribe fila por fila con xlsxwriter en modo constant_memory (cada fila va a disco al pasar
+    a la siguiente), sin copiar el DataFrame. Las URLs quedan como texto: convertirlas en
+    hipervínculos es lento y xlsxwriter admite como máximo 65530 por hoja.
+    """
+    total, accesibles = _resumen["total"], _resumen["accesibles"]
+    resumen = [
+        ("Total", total),
+        ("Accesibles", f"{accesibles}/{total}"),
+        ("Con Ciencia Abierta", _resumen["ca"]),
+        ("Con Comunicación Pública", _resumen["cp"]),
+        ("Con Diplomacia Científica", _resumen["dc"]),
+    ]
+    out = io.BytesIO()
+    wb = xlsxwriter.Workbook(out, {"constant_memory": True, "strings_to_urls": False})
+    # encabezado en negrita con borde, como el que escribe pandas 2.x con to_excel
+    encabezado = wb.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+    for nombre, columnas, filas in (
+        ("Universidades", _df.columns, _df.itertuples(index=False, name=None)),
+        ("Resumen", ("Métrica", "Valor"), resumen),
+    ):
+        ws = wb.add_worksheet(nombre)
+        ws.write_row(0, 0, columnas, encabezado)
+        for i, fila in enumerate(filas, 1):
+            ws.write_row(i, 0, [sanitize_excel_value(v) for v in fila])
+        if nombre == "Universidades":
+            ws.freeze_panes(1, 0)
+    wb.close()
+    return out.getvalue()
+
+# Alto fijo y formato de columnas explícito: el navegador no re-mide las tablas en cada rerun
+TABLA_CONFIG = {c: st.column_config.NumberColumn(format="%d")
+                for c in ("CA - Score","CP - Score","DC - Score","Score Total")}
+
+def tabla_height(n: int) -> int:
+    return min(35*n + 38, 600)
+
 # ───────────────── UI ─────────────────
 st.title("🔍 Relevador CPC — Universidades con Ciencia Abierta, CPC y Diplomacia Científica")
 st.caption("Motor: Google Custom Search JSON API (Programmable Search Engine).")
@@ -344,98 +852,139 @@ with st.sidebar:
 
 c1, c2 = st.columns([3,1])
 with c1:
-    go = st.button("🚀 Ejecutar búsqueda y análisis", type="primary", width="stretch")
+    go = st.button("🚀 Ejecutar búsqueda y análisis", type="primary", width="stretch",
+                   disabled="job" in st.session_state)
 with c2:
     clear = st.button("🗑️ Limpiar", width="stretch")
 if clear:
+    # Sin st.rerun(): la sección de resultados se evalúa más abajo en esta misma ejecución
     st.session_state.pop("results", None)
-    st.rerun()
+    st.session_state.pop("results_id", None)
 
 # ───────────────── Ejecución ─────────────────
+def run_relevamiento(terms_per_cat: int, per_page: int, pages: int, follow_links: int, report) -> pd.DataFrame:
+    """
+    Relevamiento completo: control + las tres categorías. No toca la UI; informa el avance con
+    `report(fraccion, texto)`, así puede correr en un hilo aparte mientras la página sigue viva.
+    """
+    registros: list[tuple] = []
+    steps_total = 1 + 3
+    step = 0
+
+    # Control
+    step += 1
+    report(0.0, f"Analizando población de control: {CONTROL['nombre']} ({step}/{steps_total})")
+    res_control = force_find_control(CONTROL)
+    registros.append((CONTROL["nombre"], CONTROL["pais"], CONTROL["url"], "Control", "", res_control))
+
+    # Categorías
+    scans: dict[str, dict] = {}  # url_key → scan: una página hallada en varias categorías se analiza una vez
+    scan_cache = load_json_cache(SCAN_CACHE_PATH, SCAN_CACHE_TTL)
+    cse_cache = load_json_cache(CSE_CACHE_PATH, CSE_CACHE_TTL)
+    for cat in ["ciencia_abierta","comunicacion_publica","diplomacia_cientifica"]:
+        step += 1
+        etapa = f"{cat.replace('_',' ').title()} ({step}/{steps_total})"
+        base = (step-1) / steps_total
+        report(base, f"Buscando universidades: {etapa}")
+        term_list = TERMINOS_BUSQUEDA[cat][:terms_per_cat]
+        candidates = search_universities_for_category(cat, term_list, per_page, pages, cse_cache)
+        save_json_cache(CSE_CACHE_PATH, cse_cache)  # la cuota ya gastada no se pierde si algo falla después
+        nuevas: dict[str, str] = {}  # url_key → primera URL con esa clave
+        for c in candidates:
+            if url_key(c["url"]) not in scans:
+                nuevas.setdefault(url_key(c["url"]), c["url"])
+        analizadas = scan_sites(
+            list(nuevas.values()), follow_links, scan_cache,
+            on_progress=lambda hechos, total: report(
+                base + hechos/total/steps_total, f"Analizando sitios: {etapa} — {hechos}/{total}"
+            ),
+        )
+        scans.update((key, analizadas[url]) for key, url in nuevas.items())
+        for c in candidates:
+            dom = url_host(c["url"])
+            registros.append((dom, country_guess(dom), c["url"], cat, c["termino"], scans[url_key(c["url"])]))
+
+    save_json_cache(SCAN_CACHE_PATH, scan_cache)
+    return results_frame(registros)
+
+def start_job(*config) -> dict:
+    """
+    Lanza run_relevamiento en un hilo de fondo. El hilo solo escribe en el dict devuelto (avance,
+    resultado o error); la página lo consulta con job_monitor sin quedar bloqueada.
+    """
+    job = {"fraccion": 0.0, "texto": "Iniciando…", "terminado": False, "resultado": None, "error": None,
+           "destino": results_path(*config)}
+    def report(fraccion: float, texto: str):
+        job["fraccion"], job["texto"] = fraccion, texto
+    def run():
+        try:
+            job["resultado"] = run_relevamiento(*config, report)
+        except Exception as e:
+            job["error"] = f"{type(e).__name__}: {e}"
+        else:
+            # Fuera del try: si no se puede guardar, el relevamiento igual terminó bien
+            save_results(job["destino"], job["resultado"])
+        finally:
+            job["terminado"] = True
+    t = threading.Thread(target=run, name="relevamiento", daemon=True)
+    add_script_run_ctx(t, get_script_run_ctx())  # para st.cache_data dentro del hilo
+    t.start()
+    return job
+
+@st.fragment(run_every=1.0)
+def job_monitor():
+    """Se re-ejecuta sola cada segundo mientras hay un relevamiento en curso."""
+    job = st.session_state.get("job")
+    if job is None:
+        return
+    if not job["terminado"]:
+        st.progress(min(job["fraccion"], 1.0))
+        st.write(job["texto"])
+        return
+    st.session_state.pop("job")
+    if job["error"]:
+        st.session_state["job_status"] = ("error", f"La búsqueda falló: {job['error']}")
+    else:
+        st.session_state["results"] = job["resultado"]
+        st.session_state["results_id"] = uuid4().hex
+        st.session_state["job_status"] = ("success", "✅ Búsqueda finalizada")
+    st.rerun()
+
+# Al abrir la app se restaura el último resultado guardado para la configuración actual
+if not st.session_state.get("restore_checked"):
+    st.session_state["restore_checked"] = True
+    previo = load_results(results_path(terms_per_cat, per_page, pages, follow_links))
+    if previo is not None and "results" not in st.session_state:
+        st.session_state["results"] = previo
+        st.session_state["results_id"] = uuid4().hex
+        st.session_state["job_status"] = ("info", "Resultados restaurados de una ejecución anterior con esta configuración.")
+
 if go:
     if not API_KEY or not CSE_CX:
         st.error("Falta configurar GOOGLE_API_KEY y/o GOOGLE_CSE_CX en Secrets o variables de entorno.")
     else:
-        st.session_state["results"] = []
-        progress = st.progress(0.0)
-        status = st.empty()
-        steps_total = 1 + 3
-        step = 0
-
-        # Control
-        step += 1
-        status.write(f"Analizando población de control: {CONTROL['nombre']} ({step}/{steps_total})")
-        res_control = force_find_control(CONTROL)
-        st.session_state["results"].append({
-            "Universidad": CONTROL["nombre"],
-            "País": CONTROL["pais"],
-            "URL": CONTROL["url"],
-            "Categoría Encontrada": "Control",
-            "Término de Búsqueda": "",
-            "Fecha Análisis": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "Sitio Accesible": "Sí" if res_control["accesible"] else "No",
-            "Idioma Detectado": res_control["idioma"],
-            "Ciencia Abierta": "Sí" if res_control["scores"]["ciencia_abierta"]>0 else "No",
-            "CA - Score": res_control["scores"]["ciencia_abierta"],
-            "CA - Términos": ", ".join(x["termino"] for x in res_control["hits"]["ciencia_abierta"]),
-            "Comunicación Pública": "Sí" if res_control["scores"]["comunicacion_publica"]>0 else "No",
-            "CP - Score": res_control["scores"]["comunicacion_publica"],
-            "CP - Términos": ", ".join(x["termino"] for x in res_control["hits"]["comunicacion_publica"]),
-            "Diplomacia Científica": "Sí" if res_control["scores"]["diplomacia_cientifica"]>0 else "No",
-            "DC - Score": res_control["scores"]["diplomacia_cientifica"],
-            "DC - Términos": ", ".join(x["termino"] for x in res_control["hits"]["diplomacia_cientifica"]),
-            "URLs Analizadas": "; ".join(res_control["urls_analizadas"]),
-            "Contenido Muestra": res_control["contenido_muestra"],
-        })
-        progress.progress(step/steps_total)
-
-        # Categorías
-        for cat in ["ciencia_abierta","comunicacion_publica","diplomacia_cientifica"]:
-            step += 1
-            status.write(f"Buscando universidades: {cat.replace('_',' ').title()} ({step}/{steps_total})")
-            term_list = TERMINOS_BUSQUEDA[cat][:terms_per_cat]
-            candidates = search_universities_for_category(cat, term_list, per_page, pages)
-            for c in candidates:
-                dom = urlparse(c["url"]).netloc.lower()
-                pais = country_guess(dom)
-                scan = scan_site(c["url"], follow_links=follow_links)
-                st.session_state["results"].append({
-                    "Universidad": dom,
-                    "País": pais,
-                    "URL": c["url"],
-                    "Categoría Encontrada": cat,
-                    "Término de Búsqueda": c["termino"],
-                    "Fecha Análisis": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "Sitio Accesible": "Sí" if scan["accesible"] else "No",
-                    "Idioma Detectado": scan["idioma"],
-                    "Ciencia Abierta": "Sí" if scan["scores"]["ciencia_abierta"]>0 else "No",
-                    "CA - Score": scan["scores"]["ciencia_abierta"],
-                    "CA - Términos": ", ".join(x["termino"] for x in scan["hits"]["ciencia_abierta"]),
-                    "Comunicación Pública": "Sí" if scan["scores"]["comunicacion_publica"]>0 else "No",
-                    "CP - Score": scan["scores"]["comunicacion_publica"],
-                    "CP - Términos": ", ".join(x["termino"] for x in scan["hits"]["comunicacion_publica"]),
-                    "Diplomacia Científica": "Sí" if scan["scores"]["diplomacia_cientifica"]>0 else "No",
-                    "DC - Score": scan["scores"]["diplomacia_cientifica"],
-                    "DC - Términos": ", ".join(x["termino"] for x in scan["hits"]["diplomacia_cientifica"]),
-                    "URLs Analizadas": "; ".join(scan["urls_analizadas"]),
-                    "Contenido Muestra": scan["contenido_muestra"],
-                })
-            progress.progress(step/steps_total)
-
-        status.write("✅ Búsqueda finalizada")
+        st.session_state.pop("results", None)
+        st.session_state["job"] = start_job(terms_per_cat, per_page, pages, follow_links)
+        st.rerun()  # para que el botón aparezca deshabilitado mientras corre
+if "job" in st.session_state:
+    job_monitor()
+if "job_status" in st.session_state:
+    tipo, msg = st.session_state.pop("job_status")
+    {"success": st.success, "info": st.info}.get(tipo, st.error)(msg)
 
 # ───────────────── Presentación ─────────────────
-if "results" in st.session_state and st.session_state["results"]:
+@st.fragment
+def render_results(df: pd.DataFrame, results_id: str):
+    """
+    Métricas, tablas, filtros, detalle y descarga. Como fragmento, cambiar un filtro o la página
+    del detalle re-ejecuta solo esta sección y no el script completo.
+    """
     st.markdown("---")
     st.subheader("📊 Resultados")
 
-    df = pd.DataFrame(st.session_state["results"])
-
-    total = len(df)
-    accesibles = (df["Sitio Accesible"]=="Sí").sum()
-    ca = (df["Ciencia Abierta"]=="Sí").sum()
-    cp = (df["Comunicación Pública"]=="Sí").sum()
-    dc = (df["Diplomacia Científica"]=="Sí").sum()
+    resumen_metricas = summarize_results(results_id, df)
+    total, accesibles = resumen_metricas["total"], resumen_metricas["accesibles"]
+    ca, cp, dc = resumen_metricas["ca"], resumen_metricas["cp"], resumen_metricas["dc"]
 
     c1, c2, c3, c4, c5 = st.columns(5)
     c1.metric("🏛️ Total", total)
@@ -447,72 +996,72 @@ if "results" in st.session_state and st.session_state["results"]:
     st.dataframe(df[[
         "Universidad","País","Categoría Encontrada","Sitio Accesible","Idioma Detectado",
         "Ciencia Abierta","Comunicación Pública","Diplomacia Científica",
-        "CA - Score","CP - Score","DC - Score","URL"
-    ]], width="stretch")
+        "CA - Score","CP - Score","DC - Score","Score Total","URL"
+    ]], width="stretch", height=tabla_height(len(df)), hide_index=True, column_config=TABLA_CONFIG)
 
     with st.expander("🔍 Filtros"):
         cols = st.columns(3)
         with cols[0]:
-            paises = ["Todos"] + sorted(df["País"].dropna().unique().tolist())
-            f_pais = st.selectbox("País", paises)
+            f_pais = st.selectbox("País", resumen_metricas["opciones_pais"])
         with cols[1]:
-            cats = ["Todas","Control","ciencia_abierta","comunicacion_publica","diplomacia_cientifica"]
-            f_cat = st.selectbox("Categoría", cats)
+            f_cat = st.selectbox("Categoría", OPCIONES_CATEGORIA)
         with cols[2]:
             solo_contenido = st.checkbox("Solo con contenido relevante", value=False)
 
-        filtered = df.copy()
+        # Una sola máscara combinada: se indexa el DataFrame una vez, sin copias intermedias
+        mask = pd.Series(True, index=df.index)
         if f_pais != "Todos":
-            filtered = filtered[filtered["País"]==f_pais]
+            mask &= df["País"].eq(f_pais)
         if f_cat != "Todas":
-            filtered = filtered[filtered["Categoría Encontrada"]==f_cat]
+            mask &= df["Categoría Encontrada"].eq(f_cat)
         if solo_contenido:
-            filtered = filtered[
-                (filtered["Ciencia Abierta"]=="Sí") |
-                (filtered["Comunicación Pública"]=="Sí") |
-                (filtered["Diplomacia Científica"]=="Sí")
-            ]
+            mask &= df["Score Total"].gt(0)
+        filtered = df[mask]
 
-        st.dataframe(filtered, width="stretch")
+        st.dataframe(filtered, width="stretch", height=tabla_height(len(filtered)), hide_index=True,
+                     column_config=TABLA_CONFIG)
 
     st.subheader("🔎 Detalle y muestra de contenido")
-    for i, row in filtered.head(40).iterrows():
-        with st.expander(f"🌐 {row['Universidad']} — {row['País']} [{row['Categoría Encontrada']}]"):
+    # Paginado: Streamlit ejecuta el cuerpo de cada expander aunque esté cerrado
+    paginas = max(1, -(-len(filtered) // DETALLE_POR_PAGINA))
+    pagina = st.number_input(f"Página (de {paginas})", min_value=1, max_value=paginas, value=1, step=1)
+    inicio = (pagina-1) * DETALLE_POR_PAGINA
+    # itertuples sobre las columnas necesarias: tuplas planas en vez de una Series por fila
+    detalle = filtered.iloc[inicio:inicio+DETALLE_POR_PAGINA][[
+        "Universidad","País","Categoría Encontrada","URL","Sitio Accesible","Idioma Detectado",
+        "CA - Score","CA - Términos","CP - Score","CP - Términos","DC - Score","DC - Términos","Contenido Muestra",
+    ]]
+    for (uni, pais, cat, url, acc, idioma, ca_s, ca_t, cp_s, cp_t, dc_s, dc_t,
+         muestra) in detalle.itertuples(index=False, name=None):
+        with st.expander(f"🌐 {uni} — {pais} [{cat}]"):
             c1, c2 = st.columns(2)
-            with c1:
-                st.write(f"**URL:** {row['URL']}")
-                st.write(f"**Accesible:** {row['Sitio Accesible']}")
-                st.write(f"**Idioma:** {row['Idioma Detectado']}")
-            with c2:
-                st.write(f"**CA Score:** {row['CA - Score']} — {row['CA - Términos']}")
-                st.write(f"**CP Score:** {row['CP - Score']} — {row['CP - Términos']}")
-                st.write(f"**DC Score:** {row['DC - Score']} — {row['DC - Términos']}")
-            st.text_area("Contenido de la página", row.get("Contenido Muestra","") or "",
-                         height=120, key=f"contenido_{i}", label_visibility="collapsed")
+            # Un solo bloque markdown por columna (saltos "  \n"): menos elementos a enviar por rerun
+            c1.markdown(
+                f"**URL:** {url}  \n"
+                f"**Accesible:** {acc}  \n"
+                f"**Idioma:** {idioma}"
+            )
+            c2.markdown(
+                f"**CA Score:** {ca_s} — {ca_t}  \n"
+                f"**CP Score:** {cp_s} — {cp_t}  \n"
+                f"**DC Score:** {dc_s} — {dc_t}"
+            )
+            # Solo lectura: contenedor con scroll en vez de un text_area con estado por fila
+            with st.container(height=120):
+                st.text(muestra or "")
 
     st.markdown("---")
     st.subheader("📥 Exportar Excel")
 
-    if st.button("📊 Generar Excel Completo", width="stretch"):
-        with st.spinner("Generando Excel..."):
-            df_export = sanitize_dataframe_for_excel(df.copy())
-            out = io.BytesIO()
-            with pd.ExcelWriter(out, engine="openpyxl") as writer:
-                df_export.to_excel(writer, sheet_name="Universidades", index=False)
-                resumen = pd.DataFrame([
-                    {"Métrica":"Total", "Valor": total},
-                    {"Métrica":"Accesibles", "Valor": f"{accesibles}/{total}"},
-                    {"Métrica":"Con Ciencia Abierta", "Valor": ca},
-                    {"Métrica":"Con Comunicación Pública", "Valor": cp},
-                    {"Métrica":"Con Diplomacia Científica", "Valor": dc},
-                ])
-                resumen = sanitize_dataframe_for_excel(resumen)
-                resumen.to_excel(writer, sheet_name="Resumen", index=False)
-            out.seek(0)
-            st.download_button(
-                label="⬇️ Descargar Relevamiento_CPC.xlsx",
-                data=out,
-                file_name=f"relevamiento_cpc_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
-            st.success("✅ Excel generado")
+    # `data` diferido: el libro se arma (o se toma de caché) recién al hacer clic, en otro hilo,
+    # y los bytes no quedan retenidos en la sesión mientras nadie descarga
+    st.download_button(
+        label="⬇️ Descargar Relevamiento_CPC.xlsx",
+        data=lambda: build_excel_bytes(results_id, df, resumen_metricas),
+        file_name=f"relevamiento_cpc_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        width="stretch",
+    )
+
+if "results" in st.session_state and not st.session_state["results"].empty:
+    render_results(st.session_state["results"], st.session_state.setdefault("results_id", uuid4().hex))